@@ -1,14 +1,20 @@
 # app.py
-from flask import Flask, request, jsonify
-import numpy as np
+from flask import Flask, Response, request, jsonify, stream_with_context
+import json
 import traceback
 import logging
-from datetime import datetime
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-from model import generate_answer
+from model import init_model, generate_answer, stream_answer, batch_generate
 from database import VectorDatabase
 from utils import preprocess_data, validate_inputs
-from config import FLASK_CONFIG, INDEX_DIR
+from cache import AnswerCache, get_query_embedding
+import cache as embedding_cache
+from config import FLASK_CONFIG, MODEL_CONFIG, INDEX_DIR
 
 # 配置日志
 logging.basicConfig(
@@ -20,20 +26,101 @@ logger = logging.getLogger(__name__)
 # 初始化Flask应用
 app = Flask(__name__)
 
-# 初始化向量数据库
+# 向量数据库（在 init_services 中从磁盘加载）
 vector_db = VectorDatabase()
 vector_db_path = f"{INDEX_DIR}/vector_db"
 
-# 尝试加载现有数据库
-try:
-    vector_db.load(vector_db_path)
-    logger.info(f"已加载向量数据库，包含 {len(vector_db.documents)} 个文档")
-except Exception as e:
-    logger.warning(f"加载向量数据库失败: {e}")
-    logger.info("将创建新的向量数据库")
+# 存储查询历史（最多保留100条）
+query_history = deque(maxlen=100)
+# 历史记录中响应时间的累计和，统计接口无需遍历历史
+_response_time_sum = 0.0
+_history_lock = threading.Lock()
 
-# 存储查询历史
-query_history = []
+# 语义回答缓存（请求中指定 ?cache=1 时使用）
+answer_cache = AnswerCache()
+
+# 后台线程池：批量查询生成回答时预取下一块的检索结果
+executor = ThreadPoolExecutor(max_workers=2)
+
+def init_services():
+    """
+    初始化worker的服务（向量数据库、示例数据、后台保存线程、生成模型）
+    
+    必须在worker fork之后调用（见 gunicorn.conf.py）：模型可能占用CUDA；
+    向量数据库若在master中加载，重启的worker会从过期的快照开始，
+    保存时覆盖其他worker已写入磁盘的数据。
+    """
+    # 加载现有数据库
+    try:
+        vector_db.load(vector_db_path)
+        logger.info(f"已加载向量数据库，包含 {len(vector_db.documents)} 个文档")
+    except Exception as e:
+        logger.warning(f"加载向量数据库失败: {e}")
+        logger.info("将创建新的向量数据库")
+    
+    # 初始化示例数据（如果数据库为空）
+    if not vector_db.documents:
+        logger.info("数据库为空，添加示例文档...")
+        example_docs = [
+            "公司政策规定，所有员工每年可以享受10天的带薪年假。",
+            "员工在公司入职满一年后可以获得额外的年终奖金。",
+            "公司支持员工每周三在家办公，支持远程工作。",
+            "我们的医疗保险包括门诊和住院费用的报销。",
+            "公司设有内部学习与培训计划，员工可以自由报名参加。"
+        ]
+        
+        # 预处理并添加
+        embeddings, normalized_docs = preprocess_data(example_docs, mode="embedding", return_texts=True)
+        vector_db.add_embeddings(embeddings, normalized_docs)
+        vector_db.save(vector_db_path)
+    
+    # 启动后台保存线程（线程不会随fork复制，必须在worker中启动）
+    vector_db.start_background_writer(vector_db_path)
+    
+    # 加载生成模型，避免首个请求承担加载开销
+    init_model()
+
+def build_context(context, retrieved_docs):
+    """构建上下文（如果提供了额外上下文，与检索结果合并）"""
+    if context:
+        # 使用提供的上下文作为主要信息
+        combined_context = context
+        if retrieved_docs:
+            combined_context += "\n\n相关补充信息:\n" + "\n".join(retrieved_docs)
+    else:
+        # 仅使用检索结果
+        combined_context = "\n".join(retrieved_docs) if retrieved_docs else "暂无相关信息"
+    return combined_context
+
+def retrieve_batch(questions, k, threshold):
+    """批量生成查询嵌入并检索"""
+    query_embeddings = preprocess_data(questions, mode="embedding")
+    return vector_db.search_batch(query_embeddings, k=k, threshold=threshold)
+
+def record_query(question, context, answer, retrieved_docs, distances, response_time):
+    """记录查询历史（deque自动淘汰最旧的记录），同步维护响应时间的累计和"""
+    global _response_time_sum
+    
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "question": question,
+        "context_preview": context[:100] + "..." if context and len(context) > 100 else context,
+        "answer_preview": answer[:100] + "..." if len(answer) > 100 else answer,
+        "retrieved_docs_count": len(retrieved_docs),
+        "response_time": response_time,
+        "retrieval_distances": distances if distances else []
+    }
+    
+    with _history_lock:
+        # 即将被淘汰的记录从累计和中扣除
+        if len(query_history) == query_history.maxlen:
+            _response_time_sum -= query_history[0]["response_time"]
+        query_history.append(record)
+        _response_time_sum += response_time
+
+def format_sse(event, data):
+    """格式化一条SSE消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.route('/')
 def home():
@@ -56,7 +143,7 @@ def health_check():
     """健康检查"""
     return jsonify({
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "vector_db": vector_db.get_stats(),
         "model": "gpt2-medium"
     })
@@ -67,22 +154,27 @@ def get_stats():
     stats = vector_db.get_stats()
     
     # 添加查询历史统计
-    history_stats = {
-        "total_queries": len(query_history),
-        "recent_queries": query_history[-10:] if query_history else [],
-        "average_response_time": np.mean([q.get('response_time', 0) for q in query_history]) if query_history else 0
-    }
+    with _history_lock:
+        history_stats = {
+            "total_queries": len(query_history),
+            "recent_queries": list(query_history)[-10:],
+            "average_response_time": _response_time_sum / len(query_history) if query_history else 0
+        }
     
     stats.update(history_stats)
+    stats["embedding_cache"] = embedding_cache.stats()
+    stats["answer_cache"] = answer_cache.stats()
     return jsonify(stats)
 
 @app.route('/history', methods=['GET'])
 def get_history():
     """获取查询历史"""
     limit = request.args.get('limit', 10, type=int)
+    with _history_lock:
+        history = list(query_history)
     return jsonify({
-        "total": len(query_history),
-        "history": query_history[-limit:]
+        "total": len(history),
+        "history": history[-limit:]
     })
 
 @app.route('/add_document', methods=['POST'])
@@ -97,17 +189,17 @@ def add_document():
         if not documents:
             return jsonify({"error": "documents字段不能为空"}), 400
         
-        # 预处理文档
-        embeddings = preprocess_data(documents, mode="embedding")
+        # 预处理文档，同时取得实际编码的规范化文本
+        embeddings, normalized_documents = preprocess_data(documents, mode="embedding", return_texts=True)
         
         # 获取元数据（可选）
         metadata_list = data.get("metadata", [])
         
-        # 添加到向量数据库
-        vector_db.add_embeddings(embeddings, documents, metadata_list)
+        # 添加到向量数据库（存储与嵌入向量一致的文本，同步写入预写日志）
+        vector_db.add_embeddings(embeddings, normalized_documents, metadata_list)
         
-        # 保存数据库
-        vector_db.save(vector_db_path)
+        # 由后台线程合并保存
+        vector_db.mark_dirty()
         
         return jsonify({
             "message": f"成功添加 {len(documents)} 个文档",
@@ -132,8 +224,15 @@ def query():
         "threshold": 0.5,  # 可选，相似度阈值
         "generation_config": {}  # 可选，生成参数
     }
+    
+    查询参数:
+    - stream=1: 以SSE流式返回，先发送检索结果（retrieval事件），
+      再逐段发送生成的文本（token事件），最后发送done事件
+    - cache=1: 使用语义回答缓存，相似问题且上下文相同时直接返回已有回答
     """
-    start_time = datetime.now()
+    start_time = time.perf_counter()
+    stream = request.args.get("stream", "0") == "1"
+    use_cache = request.args.get("cache", "0") == "1"
     
     try:
         data = request.json
@@ -155,8 +254,8 @@ def query():
         # 1. 检索最相似的向量
         logger.info(f"检索相似向量: question='{question[:50]}...'")
         
-        # 生成查询嵌入向量
-        query_embedding = preprocess_data([question], mode="embedding")
+        # 生成查询嵌入向量（命中缓存时跳过模型推理）
+        query_embedding = get_query_embedding(question)
         
         # 搜索向量数据库
         distances, indices, retrieved_docs = vector_db.search(query_embedding, k=k, threshold=threshold)
@@ -164,46 +263,80 @@ def query():
         logger.info(f"检索结果: 找到 {len(retrieved_docs)} 个相关文档")
         
         # 2. 构建上下文（如果提供了额外上下文，与检索结果合并）
-        if context:
-            # 使用提供的上下文作为主要信息
-            combined_context = context
-            if retrieved_docs:
-                combined_context += "\n\n相关补充信息:\n" + "\n".join(retrieved_docs)
-        else:
-            # 仅使用检索结果
-            combined_context = "\n".join(retrieved_docs) if retrieved_docs else "暂无相关信息"
+        combined_context = build_context(context, retrieved_docs)
+        
+        retrieval_info = {
+            "retrieved_count": len(retrieved_docs),
+            "distances": distances,
+            "indices": indices,
+            "documents_preview": [doc[:100] + "..." if len(doc) > 100 else doc for doc in retrieved_docs]
+        }
+        context_used = combined_context[:500] + "..." if len(combined_context) > 500 else combined_context
+        
+        # 查找语义回答缓存，命中时跳过生成
+        cached_answer = None
+        if use_cache:
+            cache_key = AnswerCache.make_key(combined_context, generation_config)
+            cached_answer = answer_cache.lookup(query_embedding, cache_key)
+        
+        if stream:
+            # 流式返回：检索结果立即发送，生成文本边生成边发送
+            def generate_events():
+                yield format_sse("retrieval", {"retrieval_info": retrieval_info, "context_used": context_used})
+                
+                chunks = []
+                try:
+                    if cached_answer is not None:
+                        text_stream = [cached_answer]
+                    else:
+                        text_stream = stream_answer(combined_context, question, generation_config)
+                    
+                    for text in text_stream:
+                        # streamer结束时会输出空字符串
+                        if not text:
+                            continue
+                        chunks.append(text)
+                        yield format_sse("token", {"text": text})
+                except Exception as e:
+                    logger.error(f"流式生成失败: {e}")
+                    yield format_sse("error", {"error": "处理查询时发生错误", "details": str(e)})
+                    return
+                
+                answer = "".join(chunks).strip()
+                if use_cache and cached_answer is None:
+                    answer_cache.add(query_embedding, cache_key, answer)
+                
+                response_time = time.perf_counter() - start_time
+                record_query(question, context, answer, retrieved_docs, distances, response_time)
+                yield format_sse("done", {
+                    "answer": answer,
+                    "cached": cached_answer is not None,
+                    "response_time": response_time,
+                    "model": "gpt2-medium"
+                })
+            
+            return Response(stream_with_context(generate_events()), mimetype="text/event-stream")
         
         # 3. 调用生成模型
-        logger.info("调用生成模型...")
-        answer = generate_answer(combined_context, question, generation_config)
+        if cached_answer is not None:
+            logger.info("命中语义回答缓存")
+            answer = cached_answer
+        else:
+            logger.info("调用生成模型...")
+            answer = generate_answer(combined_context, question, generation_config)
+            if use_cache:
+                answer_cache.add(query_embedding, cache_key, answer)
         
         # 4. 记录查询历史
-        response_time = (datetime.now() - start_time).total_seconds()
-        query_record = {
-            "timestamp": datetime.now().isoformat(),
-            "question": question,
-            "context_preview": context[:100] + "..." if context and len(context) > 100 else context,
-            "answer_preview": answer[:100] + "..." if len(answer) > 100 else answer,
-            "retrieved_docs_count": len(retrieved_docs),
-            "response_time": response_time,
-            "retrieval_distances": distances if distances else []
-        }
-        
-        # 保持历史记录不超过100条
-        query_history.append(query_record)
-        if len(query_history) > 100:
-            query_history.pop(0)
+        response_time = time.perf_counter() - start_time
+        record_query(question, context, answer, retrieved_docs, distances, response_time)
         
         # 5. 返回结果
         return jsonify({
             "answer": answer,
-            "retrieval_info": {
-                "retrieved_count": len(retrieved_docs),
-                "distances": distances,
-                "indices": indices,
-                "documents_preview": [doc[:100] + "..." if len(doc) > 100 else doc for doc in retrieved_docs]
-            },
-            "context_used": combined_context[:500] + "..." if len(combined_context) > 500 else combined_context,
+            "retrieval_info": retrieval_info,
+            "context_used": context_used,
+            "cached": cached_answer is not None,
             "response_time": response_time,
             "model": "gpt2-medium"
         })
@@ -215,12 +348,25 @@ def query():
         return jsonify({
             "error": "处理查询时发生错误",
             "details": str(e),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now(timezone.utc).isoformat()
         }), 500
 
 @app.route('/batch_query', methods=['POST'])
 def batch_query():
-    """批量查询"""
+    """
+    批量查询：按生成批大小分块，每块一次嵌入、一次向量检索、一次生成调用，
+    生成当前块时在后台预取下一块的检索结果
+    
+    请求体:
+    {
+        "queries": [{"context": "...", "question": "..."}],
+        "k": 3,  # 可选，检索的文档数量
+        "threshold": 0.5,  # 可选，相似度阈值
+        "generation_config": {}  # 可选，生成参数
+    }
+    """
+    start_time = time.perf_counter()
+    
     try:
         data = request.json
         if not data:
@@ -230,33 +376,61 @@ def batch_query():
         if not queries or not isinstance(queries, list):
             return jsonify({"error": "queries必须是列表"}), 400
         
-        results = []
-        for query_item in queries:
+        k = data.get("k", 3)
+        threshold = data.get("threshold", 0.5)
+        generation_config = data.get("generation_config", {})
+        
+        # 收集有效查询，无效项直接记录错误
+        results = [None] * len(queries)
+        pending = []
+        for position, query_item in enumerate(queries):
             context = query_item.get("context", "")
             question = query_item.get("question", "")
             
             if not question:
-                results.append({"error": "问题不能为空"})
+                results[position] = {"error": "问题不能为空"}
                 continue
             
-            # 处理单个查询
-            try:
-                response = query()
-                # 这里需要模拟query()函数的处理逻辑
-                # 实际实现中可能需要重构
-                results.append({
-                    "question": question,
-                    "answer": "模拟回答（批量查询需要重构）"
-                })
-            except Exception as e:
-                results.append({
+            pending.append((position, context, question))
+        
+        # 按生成批大小分块：生成当前块的同时，在后台预取下一块的检索结果
+        chunk_size = MODEL_CONFIG["generation_batch_size"]
+        chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        
+        future = None
+        if chunks:
+            future = executor.submit(retrieve_batch, [question for _, _, question in chunks[0]], k, threshold)
+        
+        for chunk_index, chunk in enumerate(chunks):
+            # 1. 取得当前块的检索结果，并提交下一块的检索
+            search_results = future.result()
+            if chunk_index + 1 < len(chunks):
+                next_questions = [question for _, _, question in chunks[chunk_index + 1]]
+                future = executor.submit(retrieve_batch, next_questions, k, threshold)
+            
+            # 2. 构建上下文并批量生成回答
+            combined_contexts = [
+                build_context(context, retrieved_docs)
+                for (_, context, _), (_, _, retrieved_docs) in zip(chunk, search_results)
+            ]
+            questions = [question for _, _, question in chunk]
+            generated = batch_generate(list(zip(combined_contexts, questions)), generation_config)
+            
+            for (position, _, question), (distances, indices, retrieved_docs), item in zip(chunk, search_results, generated):
+                results[position] = {
                     "question": question,
-                    "error": str(e)
-                })
+                    "answer": item["answer"],
+                    "retrieval_info": {
+                        "retrieved_count": len(retrieved_docs),
+                        "distances": distances,
+                        "indices": indices
+                    }
+                }
         
         return jsonify({
             "total": len(queries),
-            "results": results
+            "results": results,
+            "response_time": time.perf_counter() - start_time
         })
     
     except Exception as e:
@@ -272,23 +446,10 @@ def method_not_allowed(error):
     return jsonify({"error": "请求方法不允许"}), 405
 
 if __name__ == "__main__":
-    logger.info(f"启动Flask应用，监听 {FLASK_CONFIG['host']}:{FLASK_CONFIG['port']}")
+    # 仅用于本地开发，生产环境请使用: gunicorn -c gunicorn.conf.py app:app
+    logger.info(f"启动Flask开发服务器，监听 {FLASK_CONFIG['host']}:{FLASK_CONFIG['port']}")
     
-    # 初始化示例数据（如果数据库为空）
-    if not vector_db.documents:
-        logger.info("数据库为空，添加示例文档...")
-        example_docs = [
-            "公司政策规定，所有员工每年可以享受10天的带薪年假。",
-            "员工在公司入职满一年后可以获得额外的年终奖金。",
-            "公司支持员工每周三在家办公，支持远程工作。",
-            "我们的医疗保险包括门诊和住院费用的报销。",
-            "公司设有内部学习与培训计划，员工可以自由报名参加。"
-        ]
-        
-        # 预处理并添加
-        embeddings = preprocess_data(example_docs, mode="embedding")
-        vector_db.add_embeddings(embeddings, example_docs)
-        vector_db.save(vector_db_path)
+    init_services()
     
     # 启动Flask应用
     app.run(
@@ -296,4 +457,4 @@ if __name__ == "__main__":
         port=FLASK_CONFIG['port'],
         debug=FLASK_CONFIG['debug'],
         threaded=FLASK_CONFIG['threaded']
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,165 @@
+# cache.py
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+
+import faiss
+import numpy as np
+
+from utils import preprocess_data, normalize_text
+from config import CACHE_CONFIG
+
+# 全局查询嵌入缓存（进程内共享）
+_embedding_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+def normalize_question(question):
+    """规范化问题文本：去除首尾空白、转小写、NFC归一化"""
+    return normalize_text(question).lower()
+
+def _cache_key(normalized):
+    """计算缓存键（规范化文本的SHA-256）"""
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def get_query_embedding(question):
+    """
+    获取问题的嵌入向量（带LRU缓存）
+    
+    参数:
+    - question: 问题文本
+    
+    返回:
+    - embedding: 形状为 (1, dim) 的只读 float32 向量
+    """
+    global _hits, _misses
+    
+    normalized = normalize_question(question)
+    key = _cache_key(normalized)
+    
+    with _cache_lock:
+        embedding = _embedding_cache.get(key)
+        if embedding is not None:
+            _embedding_cache.move_to_end(key)
+            _hits += 1
+            return embedding
+        _misses += 1
+    
+    # 在锁外计算嵌入，避免阻塞其他请求
+    embedding = preprocess_data([normalized], mode="embedding")
+    embedding.setflags(write=False)
+    
+    with _cache_lock:
+        _embedding_cache[key] = embedding
+        _embedding_cache.move_to_end(key)
+        while len(_embedding_cache) > CACHE_CONFIG["embedding_cache_size"]:
+            _embedding_cache.popitem(last=False)
+    
+    return embedding
+
+def clear_cache():
+    """清空缓存并重置统计"""
+    global _hits, _misses
+    with _cache_lock:
+        _embedding_cache.clear()
+        _hits = 0
+        _misses = 0
+
+def stats():
+    """获取缓存统计信息"""
+    with _cache_lock:
+        total = _hits + _misses
+        return {
+            "hits": _hits,
+            "misses": _misses,
+            "hit_rate": _hits / total if total else 0.0,
+            "size": len(_embedding_cache),
+            "max_size": CACHE_CONFIG["embedding_cache_size"]
+        }
+
+class AnswerCache:
+    """
+    语义回答缓存
+    
+    以问题嵌入为键：新问题与缓存问题的内积相似度超过阈值，
+    且上下文与生成参数完全相同时，直接复用已生成的回答。
+    """
+    
+    # 每次查找检查的最相似缓存条目数
+    SEARCH_K = 8
+    
+    def __init__(self, max_size=None, similarity=None):
+        self.max_size = max_size or CACHE_CONFIG["answer_cache_size"]
+        self.similarity = similarity or CACHE_CONFIG["answer_similarity"]
+        
+        # 索引在首次添加时按嵌入维度创建
+        self.index = None
+        self.entries = {}  # id -> (context_key, answer)
+        self._order = deque()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(context, generation_config=None):
+        """计算上下文与生成参数的键"""
+        payload = json.dumps([context, generation_config or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def lookup(self, embedding, context_key):
+        """
+        查找缓存的回答
+        
+        参数:
+        - embedding: 归一化的问题嵌入，形状为 (1, dim)
+        - context_key: make_key 的返回值
+        
+        返回:
+        - 命中时返回回答，否则返回None
+        """
+        with self._lock:
+            if self.index is not None and self.index.ntotal > 0:
+                k = min(self.SEARCH_K, self.index.ntotal)
+                scores, ids = self.index.search(embedding, k)
+                for score, entry_id in zip(scores[0], ids[0]):
+                    if entry_id == -1 or score < self.similarity:
+                        break
+                    entry = self.entries.get(int(entry_id))
+                    if entry is not None and entry[0] == context_key:
+                        self.hits += 1
+                        return entry[1]
+            
+            self.misses += 1
+            return None
+    
+    def add(self, embedding, context_key, answer):
+        """添加回答到缓存，超出容量时淘汰最早的条目"""
+        with self._lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap(faiss.IndexFlatIP(embedding.shape[1]))
+            
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(embedding, np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = (context_key, answer)
+            self._order.append(entry_id)
+            
+            while len(self._order) > self.max_size:
+                oldest = self._order.popleft()
+                self.index.remove_ids(np.array([oldest], dtype=np.int64))
+                del self.entries[oldest]
+    
+    def stats(self):
+        """获取缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.entries),
+                "max_size": self.max_size
+            }
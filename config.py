@@ -6,14 +6,35 @@ import os
 FLASK_CONFIG = {
     "host": "0.0.0.0",
     "port": 5000,
-    "debug": True,
+    "debug": False,
     "threaded": True,
+    "workers": 1,  # 模型位于单个GPU上，只使用一个worker进程
+    "threads": 8,  # worker内的线程数，处理IO并发
+    # gthread worker在主循环中发送心跳，超时实际限制的是worker启动（加载数据库和模型、编译预热）
+    "timeout": int(os.environ.get("QA_WORKER_TIMEOUT", "600")),
 }
 
 # 模型配置
 MODEL_NAME = "gpt2-medium"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# 模型推理优化配置
+MODEL_CONFIG = {
+    "prefix_kv_cache": True,  # 复用提示词固定前缀的KV缓存
+    "quantize_cpu": True,  # CPU上对Linear层做动态int8量化
+    "compile": True,  # GPU上使用torch.compile编译前向计算
+    "compile_mode": "default",  # KV缓存长度逐步增长，reduce-overhead的CUDA Graph会按形状反复捕获
+    "stream_timeout": 120,  # 流式输出时等待下一个token的最长秒数
+    "generation_batch_size": 8,  # 批量查询时每次generate处理的问题数
+}
+
+# 嵌入模型配置
+EMBEDDING_CONFIG = {
+    "backend": "torch",  # torch, onnx, openvino；onnx/openvino需安装sentence-transformers对应扩展
+    "attn_implementation": "sdpa",  # 使用PyTorch融合的scaled_dot_product_attention
+    "fp16_autocast": True,  # GPU上以fp16自动混合精度编码
+}
+
 # 生成参数
 GENERATION_CONFIG = {
     "max_length": 200,
@@ -30,7 +51,22 @@ VECTOR_DB_CONFIG = {
     "dimension": 768,
     "nlist": 100,
     "nprobe": 10,
-    "index_type": "ivfflat",  # flat, ivfflat, ivfpq, hnsw
+    "index_type": "hnswsq",  # flat, ivfflat, ivfpq, hnsw, hnswsq
+    "sq_type": "fp16",  # hnswsq的标量量化类型，只支持fp16（无需训练取值范围）
+    "train_sample_size": 10000,  # 训练索引使用的最大样本数
+    "hnsw_m": 32,  # HNSW每个节点的连接数
+    "ef_construction": 200,  # HNSW构建时的候选队列长度
+    "ef_search": 64,  # HNSW搜索时的最小候选队列长度
+    "rerank_factor": 4,  # 两阶段检索：先取 k*rerank_factor 个候选再精确重排序，1表示不重排序
+    "omp_threads": max(1, (os.cpu_count() or 2) // 2),  # FAISS并行搜索线程数
+    "flush_interval": 2.0,  # 后台保存线程检查间隔（秒）
+}
+
+# 缓存配置
+CACHE_CONFIG = {
+    "embedding_cache_size": 2048,  # 查询嵌入LRU缓存容量
+    "answer_cache_size": 1000,  # 语义回答缓存容量（先进先出淘汰）
+    "answer_similarity": 0.95,  # 问题嵌入相似度超过该值视为同一问题
 }
 
 # 路径配置
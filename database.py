@@ -2,9 +2,18 @@
 import faiss
 import numpy as np
 import pickle
+import json
 import os
-from typing import List, Dict, Tuple
-from config import VECTOR_DB_CONFIG, INDEX_DIR
+import shutil
+import time
+import atexit
+import threading
+from typing import List, Dict
+from config import VECTOR_DB_CONFIG
+from utils_fast import NUMBA_AVAILABLE
+
+if NUMBA_AVAILABLE:
+    from utils_fast import refine
 
 class VectorDatabase:
     """向量数据库管理类"""
@@ -25,6 +34,8 @@ class VectorDatabase:
         # 初始化索引
         self.index = None
         self.quantizer = None
+        # 以只读内存映射方式加载的索引文件路径（首次写入前重新完整读入，None表示可写）
+        self._mmap_index_path = None
         
         # 存储数据
         self.documents = []
@@ -32,8 +43,19 @@ class VectorDatabase:
         self.document_ids = []
         self.next_id = 0
         
-        # 嵌入向量存储（用于重新训练）
-        self.embeddings_cache = []
+        # 嵌入向量存储（用于重新训练），连续的float32矩阵，按倍增策略扩容
+        self.embeddings_cache = None
+        self._n_used = 0
+        
+        # 写入锁及后台保存状态
+        self._write_lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._persist_path = None
+        self._flusher_thread = None
+        
+        # 设置FAISS的OpenMP线程数，使批量搜索并行化
+        faiss.omp_set_num_threads(VECTOR_DB_CONFIG["omp_threads"])
         
         print(f"向量数据库初始化: dim={self.dim}, nlist={self.nlist}, type={self.index_type}")
     
@@ -41,37 +63,162 @@ class VectorDatabase:
         """创建索引"""
         if self.index_type == "flat":
             # 平面索引（精确搜索）
-            self.index = faiss.IndexFlatL2(self.dim)
+            base_index = faiss.IndexFlatL2(self.dim)
             
         elif self.index_type == "ivfflat":
             # IVF平面索引
             self.quantizer = faiss.IndexFlatL2(self.dim)
-            self.index = faiss.IndexIVFFlat(self.quantizer, self.dim, self.nlist)
+            base_index = faiss.IndexIVFFlat(self.quantizer, self.dim, self.nlist)
             
         elif self.index_type == "ivfpq":
             # IVF产品量化索引
             self.quantizer = faiss.IndexFlatL2(self.dim)
             m = 8  # 子空间数
             bits = 8  # 比特数
-            self.index = faiss.IndexIVFPQ(self.quantizer, self.dim, self.nlist, m, bits)
+            base_index = faiss.IndexIVFPQ(self.quantizer, self.dim, self.nlist, m, bits)
             
         elif self.index_type == "hnsw":
-            # HNSW图索引
-            M = 16  # 每个节点的连接数
-            self.index = faiss.IndexHNSWFlat(self.dim, M)
+            # HNSW图索引（归一化向量 + 内积，等价于余弦相似度）
+            M = VECTOR_DB_CONFIG["hnsw_m"]
+            base_index = faiss.IndexHNSWFlat(self.dim, M, faiss.METRIC_INNER_PRODUCT)
+            base_index.hnsw.efConstruction = VECTOR_DB_CONFIG["ef_construction"]
+            
+        elif self.index_type == "hnswsq":
+            # 标量量化的HNSW图索引（fp16存储向量，减少搜索时的内存带宽）。
+            # 只支持fp16：8bit需要按维度训练取值范围，而索引在首批添加时训练且不再重训，
+            # 少量样本得到的范围会截断之后的向量
+            if VECTOR_DB_CONFIG["sq_type"] != "fp16":
+                raise ValueError(f"hnswsq只支持fp16标量量化: {VECTOR_DB_CONFIG['sq_type']}")
+            M = VECTOR_DB_CONFIG["hnsw_m"]
+            base_index = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_fp16, M, faiss.METRIC_INNER_PRODUCT)
+            base_index.hnsw.efConstruction = VECTOR_DB_CONFIG["ef_construction"]
             
         else:
             raise ValueError(f"不支持的索引类型: {self.index_type}")
         
+        # 使用IDMap2保存文档ID，搜索结果直接返回文档ID
+        self.index = faiss.IndexIDMap2(base_index)
+        
         print(f"创建 {self.index_type} 索引成功")
     
+    def _is_id_mapped(self):
+        """索引是否由IDMap包装（旧版本保存的索引没有包装）"""
+        return isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2))
+    
+    def _base_index(self):
+        """获取实际执行搜索的底层索引"""
+        if self._is_id_mapped():
+            return faiss.downcast_index(self.index.index)
+        return self.index
+    
+    def _append_embeddings(self, embeddings: np.ndarray):
+        """追加嵌入向量到连续矩阵（容量不足或只读时按倍增策略重新分配）"""
+        n_new = len(embeddings)
+        needed = self._n_used + n_new
+        
+        if self.embeddings_cache is None:
+            self.embeddings_cache = np.array(embeddings, dtype=np.float32)
+            self._n_used = n_new
+            return
+        
+        if needed > len(self.embeddings_cache) or not self.embeddings_cache.flags.writeable:
+            capacity = max(needed, 2 * len(self.embeddings_cache))
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown[:self._n_used] = self.embeddings_cache[:self._n_used]
+            self.embeddings_cache = grown
+        
+        self.embeddings_cache[self._n_used:needed] = embeddings
+        self._n_used = needed
+    
+    def get_embeddings(self) -> np.ndarray:
+        """获取已存储的嵌入向量矩阵（不含预留空间）"""
+        if self.embeddings_cache is None:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return self.embeddings_cache[:self._n_used]
+    
+    def _can_rerank(self):
+        """存储的嵌入向量与索引一一对应时才能精确重排序"""
+        return (
+            VECTOR_DB_CONFIG["rerank_factor"] > 1
+            and self.embeddings_cache is not None
+            and self._n_used == self.index.ntotal
+        )
+    
+    def _rerank(self, query_vectors: np.ndarray, candidate_indices: np.ndarray, k: int, threshold: float = None):
+        """
+        使用存储的嵌入向量对候选集精确重排序
+        
+        参数:
+        - query_vectors: 查询向量矩阵，形状为 (B, dim)
+        - candidate_indices: 索引返回的候选ID，形状为 (B, n_candidates)
+        - k: 每个查询保留的数量
+        - threshold: 相似度阈值（numba内核在打分时直接过滤）
+        
+        返回:
+        - distances, indices: 形状为 (B, k)，度量与索引一致，不足k个时ID为-1
+        """
+        # 内存映射的矩阵转为普通ndarray视图（不复制），便于numba接收
+        embeddings = np.asarray(self.get_embeddings())
+        inner_product = self._uses_inner_product()
+        min_score = -np.inf if threshold is None else float(threshold)
+        
+        n_queries = len(query_vectors)
+        distances = np.zeros((n_queries, k), dtype=np.float32)
+        indices = np.full((n_queries, k), -1, dtype=np.int64)
+        
+        for row, (query, candidates) in enumerate(zip(query_vectors, candidate_indices)):
+            # 搜索不持有写入锁：并发添加时索引可能返回尚未写入该矩阵的ID，
+            # 丢弃越界ID，避免numba内核越界读取
+            candidates = candidates[(candidates != -1) & (candidates < len(embeddings))]
+            if len(candidates) == 0:
+                continue
+            
+            top = min(k, len(candidates))
+            
+            if inner_product and NUMBA_AVAILABLE:
+                # 打分、阈值过滤、取前top个融合为一次遍历
+                distances[row, :top], indices[row, :top] = refine(embeddings, query, candidates, top, min_score)
+                continue
+            
+            vectors = embeddings[candidates]
+            if inner_product:
+                # 内积越大越相似
+                scores = vectors @ query
+                order_key = -scores
+            else:
+                # 精确的L2平方距离
+                diff = vectors - query
+                scores = np.einsum('ij,ij->i', diff, diff)
+                order_key = scores
+            
+            # 部分排序取前top个，再对这top个排序
+            best = np.argpartition(order_key, top - 1)[:top]
+            best = best[np.argsort(order_key[best])]
+            
+            distances[row, :top] = scores[best]
+            indices[row, :top] = candidates[best]
+        
+        return distances, indices
+    
+    def _uses_inner_product(self):
+        """索引是否使用内积度量"""
+        return self.index is not None and self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    
+    def _to_similarity(self, distances):
+        """将索引返回的距离转换为相似度（内积索引直接返回相似度）"""
+        if self._uses_inner_product():
+            return distances
+        return 1.0 / (1.0 + distances)
+    
     def train(self, embeddings):
         """训练索引（如果需要）"""
         if hasattr(self.index, 'is_trained') and not self.index.is_trained:
+            # 只使用前 train_sample_size 个样本训练
+            embeddings = embeddings[:VECTOR_DB_CONFIG["train_sample_size"]]
             print(f"训练索引，使用 {len(embeddings)} 个样本...")
             
-            # 检查训练数据是否足够
-            if len(embeddings) < self.nlist * 39:
+            # 检查训练数据是否足够（IVF聚类需要）
+            if self.index_type.startswith("ivf") and len(embeddings) < self.nlist * 39:
                 print(f"警告: 训练数据不足，建议至少 {self.nlist * 39} 个样本")
             
             self.index.train(embeddings)
@@ -95,15 +242,12 @@ class VectorDatabase:
         self.documents.extend(documents)
         self.document_ids.extend(new_ids)
         
-        # 存储元数据
-        if metadata_list:
-            for i, meta in enumerate(metadata_list):
-                if i < len(documents):
-                    meta["id"] = new_ids[i]
-                    self.metadata.append(meta)
-        else:
-            for doc_id in new_ids:
-                self.metadata.append({"id": doc_id})
+        # 存储元数据（每个文档一条，未提供的补充默认值）
+        metadata_list = metadata_list or []
+        for i, doc_id in enumerate(new_ids):
+            meta = metadata_list[i] if i < len(metadata_list) else {}
+            meta["id"] = doc_id
+            self.metadata.append(meta)
         
         self.next_id += len(documents)
         
@@ -112,20 +256,45 @@ class VectorDatabase:
     def add_embeddings(self, embeddings: np.ndarray, documents: List[str], metadata_list: List[Dict] = None):
         """
         添加嵌入向量和对应的文档
+        
+        启用后台保存时，新增数据会同步追加到预写日志（WAL），
+        调用方随后应调用 mark_dirty() 而不是 save()。
         """
+        with self._write_lock:
+            self._add_embeddings(embeddings, documents, metadata_list)
+            if self._persist_path is not None:
+                self._append_wal(self._persist_path, len(documents))
+    
+    def _add_embeddings(self, embeddings: np.ndarray, documents: List[str], metadata_list: List[Dict] = None):
+        """添加嵌入向量和对应的文档（调用方持有写入锁）"""
         # 确保索引存在
         if self.index is None:
             self.create_index()
         
-        # 训练索引（如果需要）
+        # 内存映射的只读索引在首次写入前从文件完整读入内存
+        # （IVF的OnDiskInvertedLists不支持clone_index）
+        if self._mmap_index_path is not None:
+            self.index = faiss.read_index(self._mmap_index_path)
+            self._mmap_index_path = None
+        
+        # 内积索引需要L2归一化的向量
+        if self._uses_inner_product():
+            embeddings = np.array(embeddings, dtype=np.float32)
+            faiss.normalize_L2(embeddings)
+        
+        # 训练索引（如果需要，HNSW无需训练）
         if hasattr(self.index, 'is_trained'):
             # 检查是否已经训练过
             if not self.index.is_trained:
                 self.train(embeddings)
         
-        # 添加嵌入向量到索引
-        self.index.add(embeddings)
-        self.embeddings_cache.extend(embeddings)
+        # 添加嵌入向量到索引（文档ID按顺序分配，与文档列表位置一致）
+        if self._is_id_mapped():
+            ids = np.arange(self.next_id, self.next_id + len(embeddings), dtype=np.int64)
+            self.index.add_with_ids(embeddings, ids)
+        else:
+            self.index.add(embeddings)
+        self._append_embeddings(embeddings)
         
         # 添加文档信息
         self.add_documents(documents, metadata_list)
@@ -146,39 +315,72 @@ class VectorDatabase:
         - indices: 索引数组
         - documents: 文档列表
         """
-        if self.index is None or self.index.ntotal == 0:
-            return [], [], []
+        return self.search_batch(query_vector, k=k, threshold=threshold)[0]
+    
+    def search_batch(self, query_vectors: np.ndarray, k: int = 3, threshold: float = None):
+        """
+        批量搜索最相似的向量（一次索引调用处理所有查询）
         
-        # 设置nprobe（如果是IVF索引）
-        if hasattr(self.index, 'nprobe'):
-            self.index.nprobe = VECTOR_DB_CONFIG["nprobe"]
+        参数:
+        - query_vectors: 查询向量矩阵，形状为 (B, dim)
+        - k: 每个查询返回的最近邻数量
+        - threshold: 相似度阈值
+        
+        返回:
+        - results: 长度为B的列表，每项为 (distances, indices, documents)
+        """
+        n_queries = len(query_vectors)
+        if self.index is None or self.index.ntotal == 0:
+            return [([], [], []) for _ in range(n_queries)]
         
         # 搜索
         k = min(k, self.index.ntotal)
-        distances, indices = self.index.search(query_vector, k)
         
-        # 过滤无效结果
-        valid_indices = []
-        valid_distances = []
-        valid_documents = []
+        # 两阶段检索：索引先返回更多候选，再用存储的向量精确重排序
+        n_candidates = k
+        if self._can_rerank():
+            n_candidates = min(k * VECTOR_DB_CONFIG["rerank_factor"], self.index.ntotal)
         
-        for i in range(k):
-            idx = indices[0][i]
-            if idx == -1:  # 无效索引
-                continue
-            
-            # 应用阈值过滤
-            if threshold is not None:
-                # 计算相似度（距离越小越相似）
-                similarity = 1.0 / (1.0 + distances[0][i])
-                if similarity < threshold:
-                    continue
-            
-            valid_indices.append(idx)
-            valid_distances.append(distances[0][i])
-            valid_documents.append(self.documents[idx])
+        base_index = self._base_index()
         
-        return valid_distances, valid_indices, valid_documents
+        # 设置nprobe（如果是IVF索引）
+        if hasattr(base_index, 'nprobe'):
+            base_index.nprobe = VECTOR_DB_CONFIG["nprobe"]
+        
+        # 设置efSearch（如果是HNSW索引）
+        if hasattr(base_index, 'hnsw'):
+            base_index.hnsw.efSearch = max(VECTOR_DB_CONFIG["ef_search"], 4 * k, n_candidates)
+        
+        # FAISS要求C连续的float32矩阵，已满足时不复制
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        if query_vectors.ndim != 2:
+            raise ValueError(f"查询向量必须是二维矩阵，实际维度: {query_vectors.ndim}")
+        
+        # 内积索引需要归一化的查询向量；嵌入模型输出通常已归一化，此时跳过复制
+        if self._uses_inner_product():
+            norms = np.einsum('ij,ij->i', query_vectors, query_vectors)
+            if not np.allclose(norms, 1.0, atol=1e-4):
+                query_vectors = query_vectors.copy()
+                faiss.normalize_L2(query_vectors)
+        
+        distances, indices = self.index.search(query_vectors, n_candidates)
+        
+        if n_candidates > k:
+            distances, indices = self._rerank(query_vectors, indices, k, threshold)
+        
+        # 过滤无效结果和低于阈值的结果（并发添加时文档可能尚未写入）
+        keep = (indices != -1) & (indices < len(self.documents))
+        if threshold is not None:
+            keep &= self._to_similarity(distances) >= threshold
+        
+        results = []
+        for row_distances, row_indices, row_keep in zip(distances, indices, keep):
+            valid_indices = row_indices[row_keep].tolist()
+            valid_distances = row_distances[row_keep].tolist()
+            valid_documents = [self.documents[idx] for idx in valid_indices]
+            results.append((valid_distances, valid_indices, valid_documents))
+        
+        return results
     
     def get_context(self, query_vector: np.ndarray, k: int = 5, max_length: int = 2000):
         """
@@ -203,7 +405,7 @@ class VectorDatabase:
         
         for i, (doc, dist) in enumerate(zip(documents, distances)):
             # 计算相似度
-            similarity = 1.0 / (1.0 + dist)
+            similarity = self._to_similarity(dist)
             
             # 截断过长的文档
             if len(doc) > 500:
@@ -220,26 +422,201 @@ class VectorDatabase:
         
         return "\n\n".join(context_parts)
     
+    def _wal_paths(self, path: str):
+        """预写日志文件路径：嵌入向量（float32二进制）和文档（jsonl）"""
+        return f"{path}_wal.bin", f"{path}_wal.jsonl"
+    
+    def _append_wal(self, path: str, n_new: int):
+        """将最近添加的n_new条记录追加到预写日志"""
+        vectors_path, records_path = self._wal_paths(path)
+        
+        # 先写向量再写文档，恢复时以两者中较少的记录数为准
+        with open(vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(self.get_embeddings()[-n_new:]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        
+        with open(records_path, "a", encoding="utf-8") as f:
+            for doc, meta in zip(self.documents[-n_new:], self.metadata[-n_new:]):
+                f.write(json.dumps({"doc": doc, "meta": meta}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def _replay_wal(self, path: str):
+        """重放预写日志中尚未保存到主文件的记录"""
+        vectors_path, records_path = self._wal_paths(path)
+        if not (os.path.exists(vectors_path) and os.path.exists(records_path)):
+            return 0
+        
+        vectors = np.fromfile(vectors_path, dtype=np.float32)
+        vectors = vectors[:len(vectors) // self.dim * self.dim].reshape(-1, self.dim)
+        
+        records = []
+        with open(records_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能不完整
+                    break
+        
+        n_records = min(len(vectors), len(records))
+        if n_records == 0:
+            return 0
+        
+        # 跳过已保存到主文件的记录（保存后、删除日志前崩溃的情况）
+        keep = [i for i in range(n_records) if records[i]["meta"].get("id", self.next_id) >= self.next_id]
+        n_records = len(keep)
+        if n_records == 0:
+            return 0
+        
+        self._add_embeddings(
+            vectors[keep],
+            [records[i]["doc"] for i in keep],
+            [records[i]["meta"] for i in keep]
+        )
+        
+        print(f"从预写日志恢复 {n_records} 条记录")
+        return n_records
+    
+    def _recover_wal(self, path: str):
+        """
+        重放预写日志并立即压缩：崩溃残留的孤立向量或不完整的行
+        会使之后追加的记录与向量错位
+        """
+        with self._save_lock, self._write_lock:
+            if self._replay_wal(path):
+                self._save(path)
+            self._clear_wal(path)
+    
+    def _wal_sizes(self, path: str):
+        """预写日志文件的当前大小（不存在时为0）"""
+        return tuple(os.path.getsize(p) if os.path.exists(p) else 0 for p in self._wal_paths(path))
+    
+    def _clear_wal(self, path: str):
+        """主文件保存完成后删除预写日志"""
+        for wal_path in self._wal_paths(path):
+            if os.path.exists(wal_path):
+                os.remove(wal_path)
+    
+    def mark_dirty(self):
+        """标记有未保存的修改，由后台线程合并保存"""
+        self._dirty.set()
+    
+    def start_background_writer(self, path: str, interval: float = None):
+        """
+        启动后台保存线程
+        
+        参数:
+        - path: 保存路径
+        - interval: 检查间隔（秒）
+        """
+        # 先恢复崩溃的进程留下的预写日志，避免首次保存时清除其中尚未保存的记录
+        self._recover_wal(path)
+        self._persist_path = path
+        self._flush_interval = interval or VECTOR_DB_CONFIG["flush_interval"]
+        
+        if self._flusher_thread is None:
+            self._flusher_thread = threading.Thread(target=self._flusher, daemon=True)
+            self._flusher_thread.start()
+            atexit.register(self.flush)
+    
+    def _flusher(self):
+        """后台线程：定期将有修改的数据库保存到磁盘"""
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+    
+    def flush(self):
+        """如有未保存的修改，立即保存"""
+        if self._persist_path is None or not self._dirty.is_set():
+            return
+        
+        # 先清除标记，保存期间的新修改会重新标记
+        self._dirty.clear()
+        try:
+            self.save(self._persist_path)
+        except Exception as e:
+            print(f"后台保存向量数据库失败: {e}")
+            self._dirty.set()
+    
     def save(self, path: str):
-        """保存向量数据库"""
-        # 保存索引
-        if self.index is not None:
-            faiss.write_index(self.index, f"{path}.faiss")
-        
-        # 保存数据
-        data = {
-            "documents": self.documents,
-            "metadata": self.metadata,
-            "document_ids": self.document_ids,
-            "next_id": self.next_id,
-            "dim": self.dim,
-            "nlist": self.nlist,
-            "index_type": self.index_type,
-            "embeddings_cache": self.embeddings_cache if hasattr(self, 'embeddings_cache') else []
-        }
+        """
+        保存向量数据库
         
-        with open(f"{path}_data.pkl", "wb") as f:
-            pickle.dump(data, f)
+        写入锁内只复制快照，写文件期间不阻塞 add_embeddings。
+        """
+        with self._save_lock:
+            with self._write_lock:
+                snapshot = self._snapshot()
+                wal_sizes = self._wal_sizes(path)
+            
+            self._write_snapshot(path, snapshot)
+            
+            with self._write_lock:
+                # 保存期间没有新记录时预写日志已全部包含在主文件中；
+                # 否则保留日志，重放时按ID跳过已保存的记录
+                if self._wal_sizes(path) == wal_sizes:
+                    self._clear_wal(path)
+    
+    def _save(self, path: str):
+        """保存向量数据库（调用方持有写入锁）"""
+        self._write_snapshot(path, self._snapshot())
+    
+    def _snapshot(self):
+        """复制保存所需的状态（调用方持有写入锁）"""
+        # 旧版本可能存在元数据少于文档的情况，按ID对齐
+        if len(self.metadata) != len(self.documents):
+            meta_by_id = {meta.get("id"): meta for meta in self.metadata}
+            self.metadata = [meta_by_id.get(doc_id, {"id": doc_id}) for doc_id in self.document_ids]
+        
+        # 内存映射的只读索引加载后未修改，直接复用原文件
+        index_bytes = None
+        if self.index is not None and self._mmap_index_path is None:
+            index_bytes = faiss.serialize_index(self.index)
+        
+        return {
+            "index": index_bytes,
+            "index_source": self._mmap_index_path,
+            "data": {
+                "documents": list(self.documents),
+                "metadata": list(self.metadata),
+                "document_ids": list(self.document_ids),
+                "next_id": self.next_id,
+                "dim": self.dim,
+                "nlist": self.nlist,
+                "index_type": self.index_type
+            },
+            # 追加只写入已用行之后或重新分配，已用部分的视图保持不变
+            "embeddings": self.get_embeddings()
+        }
+    
+    def _write_snapshot(self, path: str, snapshot: Dict):
+        """将快照写入磁盘，各文件先写临时文件再替换，避免截断正被内存映射的旧文件"""
+        # 保存索引
+        if snapshot["index"] is not None:
+            with open(f"{path}.faiss.tmp", "wb") as f:
+                snapshot["index"].tofile(f)
+            os.replace(f"{path}.faiss.tmp", f"{path}.faiss")
+        elif snapshot["index_source"] is not None and snapshot["index_source"] != f"{path}.faiss":
+            shutil.copyfile(snapshot["index_source"], f"{path}.faiss.tmp")
+            os.replace(f"{path}.faiss.tmp", f"{path}.faiss")
+        
+        # 保存数据（嵌入向量单独保存）
+        tmp_path = f"{path}_data.pkl.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot["data"], f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, f"{path}_data.pkl")
+        
+        # 旧版本写入的Arrow数据文件已被取代
+        if os.path.exists(f"{path}_data.arrow"):
+            os.remove(f"{path}_data.arrow")
+        
+        # 嵌入向量以连续二进制格式单独保存
+        tmp_path = f"{path}_embeddings.npy.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, snapshot["embeddings"])
+        os.replace(tmp_path, f"{path}_embeddings.npy")
         
         print(f"向量数据库已保存到: {path}")
     
@@ -247,16 +624,16 @@ class VectorDatabase:
         """加载向量数据库"""
         # 加载索引
         if os.path.exists(f"{path}.faiss"):
-            self.index = faiss.read_index(f"{path}.faiss")
+            # IVF索引的倒排表以内存映射方式按需读入；HNSW等其他索引不受该标志影响，会完整读入内存
+            self.index = faiss.read_index(f"{path}.faiss", faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self._mmap_index_path = f"{path}.faiss"
         else:
             print(f"警告: 索引文件不存在: {path}.faiss")
             self.index = None
         
-        # 加载数据
-        if os.path.exists(f"{path}_data.pkl"):
-            with open(f"{path}_data.pkl", "rb") as f:
-                data = pickle.load(f)
-            
+        # 加载数据（兼容旧版本的Arrow格式）
+        data = self._read_data(path)
+        if data is not None:
             self.documents = data["documents"]
             self.metadata = data["metadata"]
             self.document_ids = data["document_ids"]
@@ -264,11 +641,58 @@ class VectorDatabase:
             self.dim = data["dim"]
             self.nlist = data["nlist"]
             self.index_type = data["index_type"]
-            self.embeddings_cache = data.get("embeddings_cache", [])
+            
+            # 加载嵌入向量（内存映射，按需读入）
+            if os.path.exists(f"{path}_embeddings.npy"):
+                self.embeddings_cache = np.load(f"{path}_embeddings.npy", mmap_mode="r")
+            elif data.get("embeddings_cache"):
+                # 兼容旧格式：列表形式的嵌入向量
+                self.embeddings_cache = np.asarray(data["embeddings_cache"], dtype=np.float32)
+            else:
+                self.embeddings_cache = None
+            self._n_used = len(self.embeddings_cache) if self.embeddings_cache is not None else 0
             
             print(f"向量数据库已加载，包含 {len(self.documents)} 个文档")
         else:
             print(f"警告: 数据文件不存在: {path}_data.pkl")
+        
+        # 恢复上次崩溃前未保存的记录
+        self._recover_wal(path)
+    
+    def _read_data(self, path: str):
+        """读取文档数据文件，不存在时返回None"""
+        pkl_path = f"{path}_data.pkl"
+        arrow_path = f"{path}_data.arrow"
+        
+        # 旧版本写入的Arrow文件比pickle文件新时读取Arrow文件
+        if os.path.exists(arrow_path) and (
+            not os.path.exists(pkl_path) or os.path.getmtime(arrow_path) > os.path.getmtime(pkl_path)
+        ):
+            return self._read_arrow_data(arrow_path)
+        
+        if os.path.exists(pkl_path):
+            with open(pkl_path, "rb") as f:
+                return pickle.load(f)
+        
+        return None
+    
+    def _read_arrow_data(self, arrow_path: str):
+        """读取旧版本的Arrow数据文件"""
+        import pyarrow as pa
+        
+        with pa.memory_map(arrow_path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        
+        schema_metadata = {key.decode(): value.decode() for key, value in table.schema.metadata.items()}
+        return {
+            "documents": table.column("doc").to_pylist(),
+            "metadata": [json.loads(meta) for meta in table.column("meta").to_pylist()],
+            "document_ids": table.column("id").to_pylist(),
+            "next_id": int(schema_metadata["next_id"]),
+            "dim": int(schema_metadata["dim"]),
+            "nlist": int(schema_metadata["nlist"]),
+            "index_type": schema_metadata["index_type"]
+        }
     
     def get_stats(self):
         """获取统计信息"""
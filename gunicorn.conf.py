@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+# 启动方式: gunicorn -c gunicorn.conf.py app:app
+from config import FLASK_CONFIG
+
+bind = f"{FLASK_CONFIG['host']}:{FLASK_CONFIG['port']}"
+workers = FLASK_CONFIG["workers"]
+threads = FLASK_CONFIG["threads"]
+worker_class = "gthread"
+
+# 在master中预加载应用代码和依赖库（worker间写时复制共享）；
+# 向量数据库和模型在 post_worker_init 中按worker加载，重启的worker读取磁盘上的最新数据
+preload_app = True
+
+# post_worker_init 在首次心跳之前执行，冷启动（下载/加载模型、编译预热）需要足够的时间，
+# 否则worker被判定超时后重启，陷入循环
+timeout = FLASK_CONFIG["timeout"]
+
+
+def post_worker_init(worker):
+    """worker fork之后加载向量数据库和模型（CUDA不能在fork前初始化）"""
+    from app import init_services
+    init_services()
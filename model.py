@@ -1,12 +1,28 @@
 # model.py
+import copy
+import threading
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from config import MODEL_NAME, DEVICE, GENERATION_CONFIG
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache, TextIteratorStreamer
+from config import MODEL_NAME, DEVICE, GENERATION_CONFIG, MODEL_CONFIG
 
 # 全局模型和分词器实例
 _model = None
 _tokenizer = None
 
+# 提示词模板的固定片段：PREFIX + context + MIDDLE + question + SUFFIX
+PROMPT_PREFIX = "基于以下信息，回答问题：\n\n信息：\n"
+PROMPT_MIDDLE = "\n\n问题：\n"
+PROMPT_SUFFIX = "\n\n回答："
+
+# 模板片段预计算的token ID，以及前缀的KV缓存
+_prefix_ids = None
+_middle_ids = None
+_suffix_ids = None
+_prefix_cache = None
+
+# 模型最大输入长度
+MAX_INPUT_LENGTH = 1024
+
 def init_model():
     """初始化模型和分词器"""
     global _model, _tokenizer
@@ -14,59 +30,150 @@ def init_model():
     if _model is None:
         print(f"加载模型: {MODEL_NAME}")
         _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        _model = AutoModelForCausalLM.from_pretrained(MODEL_NAME).to(DEVICE)
+        _model = AutoModelForCausalLM.from_pretrained(MODEL_NAME)
+        # GPU上使用bfloat16，CPU保持float32
+        _model = _model.to(DEVICE, dtype=torch.bfloat16 if DEVICE == "cuda" else torch.float32)
         
         # 设置pad_token
         if _tokenizer.pad_token is None:
             _tokenizer.pad_token = _tokenizer.eos_token
+        # 生成式模型批量推理需要左侧填充
+        _tokenizer.padding_side = "left"
         
         _model.eval()
+        
+        compiled = False
+        if DEVICE == "cpu" and MODEL_CONFIG["quantize_cpu"]:
+            # 动态int8量化Linear层（GPT-2的注意力/MLP使用Conv1D，仅lm_head受益）
+            _model = torch.ao.quantization.quantize_dynamic(_model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif DEVICE == "cuda" and MODEL_CONFIG["compile"]:
+            # 只编译forward，generate的解码循环仍走原有逻辑；
+            # 前缀KV缓存使用增长的DynamicCache，不使用依赖静态形状的CUDA Graph模式
+            _model.forward = torch.compile(_model.forward, mode=MODEL_CONFIG["compile_mode"], fullgraph=False)
+            compiled = True
+        
+        _init_template_ids()
+        if MODEL_CONFIG["prefix_kv_cache"]:
+            _init_prefix_cache()
+        
+        if compiled:
+            _warmup()
+        
         print("模型加载完成")
     
     return _model, _tokenizer
 
-def generate_answer(context, question, generation_config=None):
+def _warmup():
+    """用短输入调用一次generate，在服务请求前触发编译"""
+    warmup_ids = torch.tensor([_prefix_ids], device=DEVICE)
+    with torch.no_grad():
+        _model.generate(
+            warmup_ids,
+            attention_mask=torch.ones_like(warmup_ids),
+            max_new_tokens=2,
+            pad_token_id=_tokenizer.pad_token_id
+        )
+
+def _init_template_ids():
+    """预先对提示词模板的固定片段分词"""
+    global _prefix_ids, _middle_ids, _suffix_ids
+    
+    _prefix_ids = _tokenizer(PROMPT_PREFIX, add_special_tokens=False).input_ids
+    _middle_ids = _tokenizer(PROMPT_MIDDLE, add_special_tokens=False).input_ids
+    _suffix_ids = _tokenizer(PROMPT_SUFFIX, add_special_tokens=False).input_ids
+
+def _init_prefix_cache():
+    """预填充提示词固定前缀，缓存其KV供所有请求复用"""
+    global _prefix_cache
+    
+    prefix_ids = torch.tensor([_prefix_ids], device=DEVICE)
+    with torch.no_grad():
+        outputs = _model(prefix_ids, use_cache=True)
+    
+    past_key_values = outputs.past_key_values
+    if isinstance(past_key_values, tuple):
+        past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+    _prefix_cache = past_key_values
+
+def _clone_prefix_cache(batch_size):
+    """复制前缀KV缓存（generate会原地追加），并扩展到批大小"""
+    cache = copy.deepcopy(_prefix_cache)
+    if batch_size > 1:
+        cache.batch_repeat_interleave(batch_size)
+    return cache
+
+def build_prompt(context, question):
+    """构建提示词"""
+    return f"{PROMPT_PREFIX}{context}{PROMPT_MIDDLE}{question}{PROMPT_SUFFIX}"
+
+def _encode_prompts(tokenizer, contexts_questions, config):
     """
-    生成回答
+    编码提示词
     
-    参数:
-    - context: 上下文信息
-    - question: 问题
-    - generation_config: 生成参数，默认为全局配置
+    只对context和question分词，模板片段使用预计算的token ID拼接。
+    启用前缀KV缓存时前缀不参与左侧填充：填充位于前缀与可变部分之间，
+    由attention_mask屏蔽。
     
     返回:
-    - answer: 生成的回答
+    - inputs: 包含input_ids和attention_mask的字典
+    - past_key_values: 前缀KV缓存（未启用时为None）
     """
-    # 初始化模型
-    model, tokenizer = init_model()
+    use_prefix = _prefix_cache is not None and config["num_return_sequences"] == 1
     
-    # 合并配置
+    contexts = [context for context, _ in contexts_questions]
+    questions = [question for _, question in contexts_questions]
+    context_ids = tokenizer(contexts, add_special_tokens=False).input_ids
+    question_ids = tokenizer(questions, add_special_tokens=False).input_ids
+    
+    # 超出最大长度时优先截断context，再截断question
+    template_length = len(_prefix_ids) + len(_middle_ids) + len(_suffix_ids)
+    budget = MAX_INPUT_LENGTH - template_length
+    tails = []
+    for ctx_ids, q_ids in zip(context_ids, question_ids):
+        q_ids = q_ids[:budget]
+        ctx_ids = ctx_ids[:budget - len(q_ids)]
+        tail = ctx_ids + _middle_ids + q_ids + _suffix_ids
+        tails.append(tail if use_prefix else _prefix_ids + tail)
+    
+    # 左侧填充
+    batch_size = len(tails)
+    max_length = max(len(tail) for tail in tails)
+    input_ids = torch.full((batch_size, max_length), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+    for row, tail in enumerate(tails):
+        input_ids[row, max_length - len(tail):] = torch.tensor(tail, dtype=torch.long)
+        attention_mask[row, max_length - len(tail):] = 1
+    
+    past_key_values = None
+    if use_prefix:
+        prefix_ids = torch.tensor([_prefix_ids], dtype=torch.long).expand(batch_size, -1)
+        input_ids = torch.cat([prefix_ids, input_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), attention_mask], dim=1)
+        past_key_values = _clone_prefix_cache(batch_size)
+    
+    inputs = {
+        "input_ids": input_ids.to(DEVICE),
+        "attention_mask": attention_mask.to(DEVICE)
+    }
+    return inputs, past_key_values
+
+def _merge_config(generation_config=None):
+    """合并生成参数与全局配置"""
     config = GENERATION_CONFIG.copy()
     if generation_config:
         config.update(generation_config)
-    
-    # 构建提示词
-    prompt = f"""基于以下信息，回答问题：
+    return config
 
-信息：
-{context}
-
-问题：
-{question}
-
-回答："""
-    
-    # 编码输入
-    inputs = tokenizer(
-        prompt, 
-        return_tensors="pt", 
-        truncation=True, 
-        max_length=1024
-    ).to(DEVICE)
+def _generate(model, tokenizer, inputs, config, past_key_values=None, streamer=None):
+    """调用model.generate"""
+    extra_kwargs = {}
+    if past_key_values is not None:
+        extra_kwargs["past_key_values"] = past_key_values
+    if streamer is not None:
+        extra_kwargs["streamer"] = streamer
     
-    # 生成回答
     with torch.no_grad():
-        outputs = model.generate(
+        return model.generate(
             inputs["input_ids"],
             attention_mask=inputs["attention_mask"],
             max_length=config["max_length"],
@@ -78,27 +185,130 @@ def generate_answer(context, question, generation_config=None):
             do_sample=config["do_sample"],
             pad_token_id=tokenizer.pad_token_id,
             eos_token_id=tokenizer.eos_token_id,
+            use_cache=True,
+            **extra_kwargs
         )
+
+def generate_answer(context, question, generation_config=None):
+    """
+    生成回答
+    
+    参数:
+    - context: 上下文信息
+    - question: 问题
+    - generation_config: 生成参数，默认为全局配置
+    
+    返回:
+    - answer: 生成的回答
+    """
+    # 初始化模型
+    model, tokenizer = init_model()
+    
+    # 合并配置
+    config = _merge_config(generation_config)
+    
+    # 构建并编码提示词
+    inputs, past_key_values = _encode_prompts(tokenizer, [(context, question)], config)
     
-    # 解码并提取回答
-    full_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    # 生成回答
+    outputs = _generate(model, tokenizer, inputs, config, past_key_values)
     
-    # 提取回答部分（去除提示词）
-    if full_text.startswith(prompt):
-        answer = full_text[len(prompt):].strip()
-    else:
-        answer = full_text.strip()
+    # 只解码新生成的token（去除提示词）
+    prompt_length = inputs["input_ids"].shape[1]
+    answer = tokenizer.decode(outputs[0, prompt_length:], skip_special_tokens=True)
     
-    return answer
+    return answer.strip()
 
-def batch_generate(contexts_questions):
-    """批量生成回答"""
+class _StreamingGeneration:
+    """后台线程生成失败时结束streamer，并在消费端重新抛出异常"""
+    
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.error = None
+    
+    def run(self, model, tokenizer, inputs, config, past_key_values):
+        try:
+            _generate(model, tokenizer, inputs, config, past_key_values, self.streamer)
+        except Exception as e:
+            self.error = e
+            # generate异常退出时不会结束streamer，否则消费端要等到超时
+            self.streamer.end()
+    
+    def __iter__(self):
+        yield from self.streamer
+        if self.error is not None:
+            raise self.error
+
+def stream_answer(context, question, generation_config=None):
+    """
+    流式生成回答
+    
+    参数:
+    - context: 上下文信息
+    - question: 问题
+    - generation_config: 生成参数，默认为全局配置
+    
+    返回:
+    - 逐段产出生成文本的迭代器，生成失败时在迭代中抛出原异常
+    """
+    model, tokenizer = init_model()
+    
+    # 流式输出只返回一个序列
+    config = _merge_config(generation_config)
+    config["num_return_sequences"] = 1
+    
+    inputs, past_key_values = _encode_prompts(tokenizer, [(context, question)], config)
+    
+    streamer = TextIteratorStreamer(
+        tokenizer,
+        skip_prompt=True,
+        skip_special_tokens=True,
+        timeout=MODEL_CONFIG["stream_timeout"]
+    )
+    
+    # 在后台线程中生成，当前线程消费streamer
+    generation = _StreamingGeneration(streamer)
+    thread = threading.Thread(
+        target=generation.run,
+        args=(model, tokenizer, inputs, config, past_key_values),
+        daemon=True
+    )
+    thread.start()
+    
+    return generation
+
+def batch_generate(contexts_questions, generation_config=None):
+    """
+    批量生成回答（左侧填充后一次generate调用）
+    
+    参数:
+    - contexts_questions: (context, question) 元组列表
+    - generation_config: 生成参数，默认为全局配置
+    
+    返回:
+    - results: 包含context、question、answer的字典列表
+    """
+    if not contexts_questions:
+        return []
+    
+    model, tokenizer = init_model()
+    config = _merge_config(generation_config)
+    
+    # 批量编码输入（左侧填充，保证生成部分对齐在右侧）
+    inputs, past_key_values = _encode_prompts(tokenizer, contexts_questions, config)
+    
+    outputs = _generate(model, tokenizer, inputs, config, past_key_values)
+    
+    # 只解码新生成的token，每个输入取第一个返回序列
+    prompt_length = inputs["input_ids"].shape[1]
+    generated = outputs[::config["num_return_sequences"], prompt_length:]
+    answers = tokenizer.batch_decode(generated, skip_special_tokens=True)
+    
     results = []
-    for context, question in contexts_questions:
-        answer = generate_answer(context, question)
+    for (context, question), answer in zip(contexts_questions, answers):
         results.append({
             "context": context,
             "question": question,
-            "answer": answer
+            "answer": answer.strip()
         })
-    return results
\ No newline at end of file
+    return results
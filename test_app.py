@@ -1,6 +1,8 @@
 # test_app.py
 import requests
 import json
+import os
+import tempfile
 import time
 from typing import List, Dict
 
@@ -159,6 +161,190 @@ def test_query_api():
     
     return all_passed
 
+def test_query_stream():
+    """测试流式问答API"""
+    print("\n测试流式问答API...")
+    
+    payload = {
+        "context": "公司政策规定，所有员工每年可以享受10天的带薪年假。",
+        "question": "公司的带薪年假政策是什么？",
+        "k": 3,
+        "threshold": 0.3
+    }
+    
+    start_time = time.time()
+    response = requests.post(f"{API_URL}/query?stream=1", json=payload, stream=True)
+    
+    if response.status_code != 200:
+        print(f"✗ 流式API调用失败: {response.status_code} - {response.text}")
+        return False
+    
+    # 解析SSE事件
+    events = []
+    first_event_time = None
+    current_event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            current_event = line[len("event: "):]
+        elif line.startswith("data: "):
+            if first_event_time is None:
+                first_event_time = time.time() - start_time
+            events.append((current_event, json.loads(line[len("data: "):])))
+    
+    event_names = [name for name, _ in events]
+    if not event_names or event_names[0] != "retrieval":
+        print(f"✗ 首个事件应为retrieval: {event_names[:3]}")
+        return False
+    if event_names[-1] != "done":
+        print(f"✗ 最后一个事件应为done: {event_names[-1]}")
+        return False
+    
+    answer = events[-1][1].get("answer", "")
+    print(f"首个事件耗时: {first_event_time:.2f}秒，共 {len(events)} 个事件")
+    print(f"生成的回答: {answer}")
+    print(f"✓ 流式问答测试通过")
+    return True
+
+def test_answer_cache():
+    """测试语义回答缓存"""
+    print("\n测试语义回答缓存...")
+    
+    payload = {
+        "context": "我们的医疗保险包括门诊和住院费用的报销。",
+        "question": "公司的医疗保险覆盖哪些方面？",
+        "k": 3,
+        "threshold": 0.3
+    }
+    
+    # 第一次查询生成回答并写入缓存，第二次相同查询应命中缓存
+    first = requests.post(f"{API_URL}/query?cache=1", json=payload)
+    second = requests.post(f"{API_URL}/query?cache=1", json=payload)
+    
+    if first.status_code != 200 or second.status_code != 200:
+        print(f"✗ 缓存查询失败: {first.status_code}, {second.status_code}")
+        return False
+    
+    first_result = first.json()
+    second_result = second.json()
+    
+    if not second_result.get("cached"):
+        print(f"✗ 第二次查询未命中缓存")
+        return False
+    
+    if second_result.get("answer") != first_result.get("answer"):
+        print(f"✗ 缓存的回答与首次回答不一致")
+        return False
+    
+    print(f"首次响应时间: {first_result.get('response_time', 0):.2f}秒")
+    print(f"缓存响应时间: {second_result.get('response_time', 0):.2f}秒")
+    print(f"✓ 语义回答缓存测试通过")
+    return True
+
+def test_wal_replay():
+    """测试预写日志恢复（本地执行，不经过API）"""
+    print("\n测试预写日志恢复...")
+    import numpy as np
+    from database import VectorDatabase
+    
+    dim = 8
+    rng = np.random.default_rng(0)
+    path = os.path.join(tempfile.mkdtemp(), "wal_test")
+    
+    # 只写预写日志、不保存主文件，模拟保存前崩溃
+    db = VectorDatabase(dim=dim, index_type="flat")
+    db._persist_path = path
+    first = rng.random((3, dim), dtype=np.float32)
+    db.add_embeddings(first, ["文档0", "文档1", "文档2"])
+    
+    # 模拟写入中断：向量已写入但文档行未写入，且最后一行不完整
+    vectors_path, records_path = db._wal_paths(path)
+    with open(vectors_path, "ab") as f:
+        f.write(rng.random((2, dim), dtype=np.float32).tobytes())
+    with open(records_path, "a", encoding="utf-8") as f:
+        f.write('{"doc": "不完整')
+    
+    recovered = VectorDatabase(dim=dim, index_type="flat")
+    recovered.load(path)
+    if recovered.documents != ["文档0", "文档1", "文档2"]:
+        print(f"✗ 恢复的文档不正确: {recovered.documents}")
+        return False
+    if os.path.exists(vectors_path) or os.path.exists(records_path):
+        print("✗ 恢复后预写日志未被压缩")
+        return False
+    
+    # 恢复后继续写入并再次崩溃，文档与向量应保持对应
+    recovered._persist_path = path
+    second = rng.random((2, dim), dtype=np.float32)
+    recovered.add_embeddings(second, ["文档3", "文档4"])
+    
+    reloaded = VectorDatabase(dim=dim, index_type="flat")
+    reloaded.load(path)
+    if reloaded.documents != ["文档0", "文档1", "文档2", "文档3", "文档4"]:
+        print(f"✗ 二次恢复的文档不正确: {reloaded.documents}")
+        return False
+    if not np.allclose(reloaded.get_embeddings(), np.vstack([first, second])):
+        print("✗ 二次恢复的嵌入向量与文档不对应")
+        return False
+    
+    print("✓ 预写日志恢复测试通过")
+    return True
+
+def _crashing_writer(path, dim, ready):
+    """子进程：启动后台保存线程并写入一条记录，在保存前被终止"""
+    import numpy as np
+    from database import VectorDatabase
+    
+    db = VectorDatabase(dim=dim, index_type="flat")
+    db.load(path)
+    db.start_background_writer(path, interval=3600)
+    db.add_embeddings(np.full((1, dim), 0.5, dtype=np.float32), ["A"])
+    db.mark_dirty()
+    ready.set()
+    time.sleep(3600)
+
+def test_writer_crash_recovery():
+    """测试写入进程在保存前被终止后，重启的进程恢复其预写日志（本地执行，不经过API）"""
+    print("\n测试写入进程崩溃恢复...")
+    import multiprocessing
+    import numpy as np
+    from database import VectorDatabase
+    
+    dim = 8
+    rng = np.random.default_rng(0)
+    path = os.path.join(tempfile.mkdtemp(), "crash_test")
+    
+    seed = VectorDatabase(dim=dim, index_type="flat")
+    seed.add_embeddings(rng.random((3, dim), dtype=np.float32), ["s0", "s1", "s2"])
+    seed.save(path)
+    
+    # 崩溃前加载的旧状态，模拟从旧快照启动的worker
+    stale = VectorDatabase(dim=dim, index_type="flat")
+    stale.load(path)
+    
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=_crashing_writer, args=(path, dim, ready))
+    process.start()
+    written = ready.wait(60)
+    process.kill()
+    process.join()
+    if not written:
+        print("✗ 写入进程未能完成写入")
+        return False
+    
+    stale.start_background_writer(path, interval=3600)
+    stale.add_embeddings(rng.random((1, dim), dtype=np.float32), ["B"])
+    stale.mark_dirty()
+    stale.flush()
+    
+    reloaded = VectorDatabase(dim=dim, index_type="flat")
+    reloaded.load(path)
+    if reloaded.documents != ["s0", "s1", "s2", "A", "B"]:
+        print(f"✗ 崩溃进程的记录丢失: {reloaded.documents}")
+        return False
+    
+    print("✓ 写入进程崩溃恢复测试通过")
+    return True
+
 def test_error_cases():
     """测试错误情况"""
     print("\n测试错误情况...")
@@ -224,6 +410,10 @@ def run_all_tests():
         ("统计信息", test_stats),
         ("添加文档", test_add_document),
         ("问答API", test_query_api),
+        ("流式问答", test_query_stream),
+        ("回答缓存", test_answer_cache),
+        ("预写日志恢复", test_wal_replay),
+        ("写入进程崩溃恢复", test_writer_crash_recovery),
         ("错误情况", test_error_cases),
         ("批量查询", test_batch_query),
     ]
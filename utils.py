@@ -1,11 +1,28 @@
 # utils.py
+import contextlib
+import os
+import unicodedata
 import numpy as np
 import torch
-from transformers import AutoTokenizer
-from sentence_transformers import SentenceTransformer
-from config import MODEL_NAME, DEVICE
+from config import MODEL_NAME, DEVICE, EMBEDDING_CONFIG, MODEL_DIR
 
-# 全局实例
+# 限制PyTorch线程数，避免多核机器上CPU推理的线程争用（QA_TUNE_THREADS=0时不调整）
+if os.environ.get("QA_TUNE_THREADS", "1") == "1":
+    torch.set_num_threads(min(8, os.cpu_count() or 1))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # 进程内已有并行任务启动后不能再修改
+        pass
+
+# 目标行数低于该值时使用Numba/SimSIMD融合内核，否则使用BLAS
+NUMBA_SIMILARITY_THRESHOLD = 1024
+
+# 相似度内核 (cosine_sim, simsimd)，首次计算相似度时才导入，不可用的为None
+_similarity_kernels = None
+
+# 全局实例（transformers/sentence_transformers在首次获取时才导入，
+# 只使用validate_inputs、calculate_similarity的调用方无需加载）
 _tokenizer = None
 _embedding_model = None
 
@@ -13,6 +30,8 @@ def get_tokenizer():
     """获取分词器"""
     global _tokenizer
     if _tokenizer is None:
+        from transformers import AutoTokenizer
+        
         _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
         if _tokenizer.pad_token is None:
             _tokenizer.pad_token = _tokenizer.eos_token
@@ -22,10 +41,73 @@ def get_embedding_model(model_name="sentence-transformers/all-MiniLM-L6-v2"):
     """获取嵌入模型"""
     global _embedding_model
     if _embedding_model is None:
-        _embedding_model = SentenceTransformer(model_name)
+        from sentence_transformers import SentenceTransformer
+        
+        backend = EMBEDDING_CONFIG["backend"]
+        if backend == "torch":
+            _embedding_model = SentenceTransformer(
+                model_name,
+                model_kwargs={"attn_implementation": EMBEDDING_CONFIG["attn_implementation"]}
+            )
+        else:
+            _embedding_model = _load_exported_model(model_name, backend)
+        _embedding_model.eval()
     return _embedding_model
 
-def preprocess_data(texts, mode="embedding", max_length=512):
+def _load_exported_model(model_name, backend):
+    """加载ONNX/OpenVINO后端的嵌入模型，导出结果按模型名缓存在MODEL_DIR下"""
+    from sentence_transformers import SentenceTransformer
+    
+    export_dir = os.path.join(MODEL_DIR, f"{model_name.replace('/', '--')}-{backend}")
+    if os.path.isdir(export_dir):
+        return SentenceTransformer(export_dir, backend=backend)
+    
+    model = SentenceTransformer(model_name, backend=backend)
+    model.save_pretrained(export_dir)
+    return model
+
+def _embedding_autocast():
+    """GPU上编码时启用fp16自动混合精度，其余情况不做处理"""
+    if DEVICE == "cuda" and EMBEDDING_CONFIG["fp16_autocast"]:
+        return torch.autocast("cuda", dtype=torch.float16)
+    return contextlib.nullcontext()
+
+def get_similarity_kernels():
+    """获取相似度内核：numba融合内核和simsimd模块（均为可选依赖）"""
+    global _similarity_kernels
+    if _similarity_kernels is None:
+        from utils_fast import NUMBA_AVAILABLE
+        
+        cosine_sim = None
+        if NUMBA_AVAILABLE:
+            from utils_fast import cosine_sim
+        try:
+            import simsimd
+        except ImportError:
+            simsimd = None
+        _similarity_kernels = (cosine_sim, simsimd)
+    return _similarity_kernels
+
+def normalize_text(text):
+    """规范化文本：去除首尾空白并做NFC归一化"""
+    return unicodedata.normalize("NFC", text.strip())
+
+def quantize_int8(embeddings):
+    """
+    对称int8量化
+    
+    返回:
+    - quantized: int8矩阵
+    - scale: 量化比例，原值 ≈ quantized / scale
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    max_abs = float(np.abs(embeddings).max()) if embeddings.size else 0.0
+    scale = 127.0 / max_abs if max_abs > 0 else 1.0
+    quantized = np.clip(np.rint(embeddings * scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+def preprocess_data(texts, mode="embedding", max_length=512, return_texts=False, batch_size=32,
+                    dtype="float32", keep_on_device=False, n_workers=None, padding="max_length"):
     """
     预处理文本数据
     
@@ -33,66 +115,235 @@ def preprocess_data(texts, mode="embedding", max_length=512):
     - texts: 文本列表
     - mode: 模式，'embedding' 或 'tokenization'
     - max_length: 最大长度
+    - return_texts: 嵌入模式下同时返回实际编码的规范化文本
+    - batch_size: 嵌入模式下模型内部的批大小
+    - padding: 分词模式下的填充策略，'max_length' 或 'longest'（填充到本批最长）
+    - dtype: 嵌入向量类型，'float32'（FAISS索引要求）、'float16' 或 'int8'；
+      int8按整个矩阵对称量化，需要量化比例时直接调用 quantize_int8
+    - keep_on_device: 嵌入模式下返回DEVICE上的float32张量（不拷贝回主机），
+      供GPU端计算使用，此时dtype必须为'float32'
+    - n_workers: 嵌入模式下大于1时启动多进程编码（GPU上按进程轮流分配显卡），
+      keep_on_device=True时不使用
     
     返回:
-    - 嵌入向量或tokenized输入
+    - 嵌入向量或tokenized输入 (len(texts), max_length)；
+      return_texts=True时返回 (嵌入向量, 规范化文本列表)
     """
     if mode == "embedding":
         # 使用sentence transformer生成嵌入向量
         model = get_embedding_model()
-        embeddings = model.encode(
-            texts,
-            convert_to_numpy=True,
-            show_progress_bar=False,
-            normalize_embeddings=True
-        )
-        return embeddings.astype('float32')
+        normalized_texts = [normalize_text(text) for text in texts]
+        encode_kwargs = {
+            "batch_size": batch_size,
+            "show_progress_bar": False,
+            "normalize_embeddings": True
+        }
+        if keep_on_device:
+            if dtype != "float32":
+                raise ValueError("keep_on_device仅支持float32嵌入")
+            with torch.inference_mode(), _embedding_autocast():
+                embeddings = model.encode(normalized_texts, convert_to_tensor=True, device=DEVICE, **encode_kwargs)
+            embeddings = embeddings.float()
+            if return_texts:
+                return embeddings, normalized_texts
+            return embeddings
+        
+        if n_workers and n_workers > 1:
+            embeddings = _encode_multi_process(model, normalized_texts, n_workers, batch_size)
+        else:
+            with torch.inference_mode(), _embedding_autocast():
+                embeddings = model.encode(normalized_texts, convert_to_numpy=True, **encode_kwargs)
+        embeddings = embeddings.astype('float32')
+        if dtype == "float16":
+            embeddings = embeddings.astype(np.float16)
+        elif dtype == "int8":
+            # 余弦相似度与缩放无关，存储时不需要保留比例
+            embeddings, _ = quantize_int8(embeddings)
+        elif dtype != "float32":
+            raise ValueError(f"不支持的嵌入类型: {dtype}")
+        if return_texts:
+            return embeddings, normalized_texts
+        return embeddings
     
     elif mode == "tokenization":
-        # 使用GPT-2的分词器
+        # 使用GPT-2的分词器，一次调用批量分词（不经过模型，无需移动到设备）
         tokenizer = get_tokenizer()
+        inputs = tokenizer(
+            texts,
+            return_tensors="np",
+            truncation=True,
+            max_length=max_length,
+            padding=padding,
+            return_attention_mask=False
+        )
         
-        embeddings = []
-        for text in texts:
-            inputs = tokenizer(
-                text,
-                return_tensors="pt",
-                truncation=True,
-                max_length=max_length,
-                padding="max_length" if len(texts) > 1 else False
-            ).to(DEVICE)
-            
-            # 使用input_ids作为简单表示
-            embedding = inputs["input_ids"].cpu().detach().numpy()
-            embeddings.append(embedding)
-        
-        return np.array(embeddings)
+        # 使用input_ids作为简单表示，形状为 (len(texts), max_length)，
+        # padding='longest'时第二维为本批最长长度
+        return inputs["input_ids"]
     
     else:
         raise ValueError(f"不支持的预处理模式: {mode}")
 
-def batch_preprocess(texts, batch_size=32, **kwargs):
-    """批量预处理"""
-    results = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        batch_result = preprocess_data(batch, **kwargs)
-        results.append(batch_result)
+def _encode_multi_process(model, texts, n_workers, batch_size):
+    """启动n_workers个编码进程处理全部文本，完成后关闭进程池"""
+    if DEVICE == "cuda":
+        device_count = torch.cuda.device_count()
+        devices = [f"cuda:{i % device_count}" for i in range(n_workers)]
+    else:
+        devices = ["cpu"] * n_workers
+    
+    pool = model.start_multi_process_pool(devices)
+    try:
+        return model.encode_multi_process(texts, pool, batch_size=batch_size, normalize_embeddings=True)
+    finally:
+        model.stop_multi_process_pool(pool)
+
+def batch_preprocess(texts, batch_size=32, n_workers=None, **kwargs):
+    """
+    批量预处理
     
-    if len(results) == 0:
+    嵌入模式直接交给encode分批，n_workers大于1时使用多进程编码（适合大批量入库）；
+    分词模式先按文本长度排序再分批，使同一批内长度相近、减少填充，结果按原始顺序返回。
+    """
+    if len(texts) == 0:
         return np.array([])
     
-    return np.vstack(results) if kwargs.get('mode') == 'embedding' else np.concatenate(results, axis=0)
+    # 嵌入模式：encode内部已按长度排序并分批，直接传入全部文本
+    if kwargs.get("mode", "embedding") == "embedding":
+        return preprocess_data(texts, batch_size=batch_size, n_workers=n_workers, **kwargs)
+    
+    mode = kwargs["mode"]
+    if mode != "tokenization":
+        raise ValueError(f"不支持的预处理模式: {mode}")
+    
+    # 输出预先填满pad_token_id；各批只填充到本批最长，写入对应行的前部
+    kwargs.pop("padding", None)
+    max_length = kwargs.get("max_length", 512)
+    output = np.full((len(texts), max_length), get_tokenizer().pad_token_id, dtype=np.int64)
+    
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    for i in range(0, len(texts), batch_size):
+        batch_order = order[i:i+batch_size]
+        input_ids = preprocess_data([texts[j] for j in batch_order], padding="longest", **kwargs)
+        output[batch_order, :input_ids.shape[1]] = input_ids
+    
+    return output
+
+class NormalizedMatrix:
+    """
+    缓存L2归一化结果的目标向量矩阵
+    
+    对同一语料重复计算相似度时只归一化一次，之后每次查询为单次GEMV。
+    """
+    
+    def __init__(self, vectors, pre_normalized=False):
+        """
+        参数:
+        - vectors: 目标向量矩阵 (N, dim)
+        - pre_normalized: 向量是否已L2归一化，为True时直接复用
+        """
+        self.vectors = vectors
+        self._normalized = None
+        if pre_normalized:
+            self._normalized = np.ascontiguousarray(vectors, dtype=np.float32)
+    
+    @property
+    def normalized(self):
+        """归一化后的float32矩阵，首次访问时计算"""
+        if self._normalized is None:
+            vectors = np.asarray(self.vectors, dtype=np.float32)
+            norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+            self._normalized = np.ascontiguousarray(vectors / norms[:, np.newaxis])
+        return self._normalized
+    
+    def __len__(self):
+        return len(self.vectors)
+
+def calculate_similarity(query_vector, target_vectors, targets_normalized=False):
+    """
+    计算余弦相似度
+    
+    参数:
+    - query_vector: 查询向量
+    - target_vectors: 目标向量矩阵 (N, dim)，float32/float16/int8，
+      或 NormalizedMatrix（复用其缓存的归一化矩阵）
+    - targets_normalized: 目标向量是否已L2归一化（preprocess_data的嵌入输出、
+      VectorDatabase.get_embeddings() 即是），为True时只做一次矩阵-向量乘
+    
+    返回:
+    - similarities: 形状为 (N,) 的相似度
+    """
+    # 一维连续float32查询向量，np.dot对连续float32输入直接调用SGEMV
+    query_vector = np.ascontiguousarray(np.ravel(query_vector), dtype=np.float32)
+    if getattr(target_vectors, "dtype", None) in (np.float16, np.int8):
+        return _quantized_similarity(query_vector, target_vectors)
+    
+    # 归一化查询向量（vdot避免linalg.norm的通用分派开销）
+    query_norm = query_vector / np.sqrt(np.vdot(query_vector, query_vector))
+    
+    if isinstance(target_vectors, NormalizedMatrix):
+        return np.dot(target_vectors.normalized, query_norm)
+    
+    # 切片等非连续输入会退出BLAS快速路径，统一转换为连续float32（已满足时不复制）
+    target_vectors = np.ascontiguousarray(target_vectors, dtype=np.float32)
+    
+    if targets_normalized:
+        # 目标向量已在入库时归一化：单次GEMV即为余弦相似度
+        return np.dot(target_vectors, query_norm)
+    
+    # 小矩阵：BLAS调用开销占主导，使用一次遍历同时计算点积和范数的融合内核
+    if len(target_vectors) < NUMBA_SIMILARITY_THRESHOLD:
+        cosine_sim, simsimd = get_similarity_kernels()
+        if cosine_sim is not None:
+            similarities = np.empty(len(target_vectors), dtype=np.float32)
+            cosine_sim(query_vector, target_vectors, similarities)
+            return similarities
+        if simsimd is not None:
+            distances = simsimd.cdist(query_vector.reshape(1, -1), target_vectors, metric="cosine")
+            return 1.0 - np.asarray(distances).ravel()
+    
+    # 大矩阵：多线程BLAS GEMV计算点积后除以各行范数，不生成归一化后的矩阵副本
+    similarities = np.dot(target_vectors, query_norm)
+    similarities /= np.sqrt(np.einsum('ij,ij->i', target_vectors, target_vectors))
+    return similarities
+
+def calculate_similarity_torch(query_vector, target_vectors, targets_normalized=False):
+    """
+    在张量所在设备上计算余弦相似度
+    
+    参数:
+    - query_vector: 查询向量张量 (dim,) 或 (1, dim)
+    - target_vectors: 目标向量张量 (N, dim)
+    - targets_normalized: 目标向量是否已L2归一化（keep_on_device的嵌入输出即是）
+    
+    返回:
+    - similarities: 形状为 (N,) 的相似度张量，与输入位于同一设备
+    """
+    query_norm = torch.nn.functional.normalize(query_vector.reshape(-1), dim=0)
+    if not targets_normalized:
+        target_vectors = torch.nn.functional.normalize(target_vectors, dim=1)
+    return target_vectors @ query_norm
 
-def calculate_similarity(query_vector, target_vectors):
-    """计算相似度"""
-    # 归一化向量
-    query_norm = query_vector / np.linalg.norm(query_vector)
-    target_norms = target_vectors / np.linalg.norm(target_vectors, axis=1, keepdims=True)
+def _quantized_similarity(query_vector, target_vectors):
+    """float16/int8目标向量的余弦相似度，查询向量转换为相同类型后计算"""
+    targets = np.ascontiguousarray(target_vectors)
+    _, simsimd = get_similarity_kernels()
+    if simsimd is None:
+        # NumPy没有低精度BLAS内核，提升为float32计算
+        return calculate_similarity(query_vector, targets.astype(np.float32))
     
-    # 计算余弦相似度
-    similarities = np.dot(target_norms, query_norm.T)
-    return similarities.flatten()
+    if targets.dtype == np.int8:
+        query, _ = quantize_int8(query_vector)
+    else:
+        query = query_vector.astype(np.float16)
+    distances = simsimd.cdist(query.reshape(1, -1), targets, metric="cosine")
+    return 1.0 - np.asarray(distances).ravel()
+
+def _stripped_length(text):
+    """去除首尾空白后的长度：首尾都不是空白时无需strip()"""
+    if not text[:1].isspace() and not text[-1:].isspace():
+        return len(text)
+    return len(text.strip())
 
 def validate_inputs(context, question, min_length=5):
     """验证输入"""
@@ -100,12 +351,12 @@ def validate_inputs(context, question, min_length=5):
     
     if not context or not isinstance(context, str):
         errors.append("context必须是非空字符串")
-    elif len(context.strip()) < min_length:
+    elif _stripped_length(context) < min_length:
         errors.append(f"context长度必须至少{min_length}个字符")
     
     if not question or not isinstance(question, str):
         errors.append("question必须是非空字符串")
-    elif len(question.strip()) < min_length:
+    elif _stripped_length(question) < min_length:
         errors.append(f"question长度必须至少{min_length}个字符")
     
     return errors
\ No newline at end of file
@@ -0,0 +1,82 @@
+# utils_fast.py
+import numpy as np
+
+# numba为可选依赖，不可用时调用方回退到NumPy实现
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# 允许重排和融合乘加，但不假设无穷/NaN不存在（-inf用作阈值和空位）
+FASTMATH_FLAGS = {"contract", "reassoc", "arcp"}
+
+if NUMBA_AVAILABLE:
+    @njit(fastmath=FASTMATH_FLAGS, cache=True, nogil=True)
+    def refine(embs, q, cand, k, thr):
+        """
+        候选集精确重排序：内积打分、阈值过滤、取前k个，一次遍历完成
+        
+        参数:
+        - embs: 嵌入向量矩阵 (N, dim)，float32
+        - q: 查询向量 (dim,)，float32
+        - cand: 候选ID (n_candidates,)，int64，-1表示无效
+        - k: 保留数量
+        - thr: 内积阈值，低于阈值的候选被丢弃
+        
+        返回:
+        - top_scores: 按内积降序排列的分数 (k,)，不足k个时为-inf
+        - top_ids: 对应的ID (k,)，不足k个时为-1
+        """
+        dim = q.shape[0]
+        top_scores = np.full(k, -np.inf, dtype=np.float32)
+        top_ids = np.full(k, -1, dtype=np.int64)
+        count = 0
+        
+        # 候选数只有k的几倍，串行打分，用插入排序维护前k个
+        for i in range(cand.shape[0]):
+            c = cand[i]
+            if c < 0:
+                continue
+            s = 0.0
+            for j in range(dim):
+                s += embs[c, j] * q[j]
+            if s < thr or (count == k and s <= top_scores[k - 1]):
+                continue
+            
+            j = count if count < k else k - 1
+            while j > 0 and top_scores[j - 1] < s:
+                top_scores[j] = top_scores[j - 1]
+                top_ids[j] = top_ids[j - 1]
+                j -= 1
+            top_scores[j] = s
+            top_ids[j] = c
+            if count < k:
+                count += 1
+        
+        return top_scores, top_ids
+    
+    @njit(fastmath=FASTMATH_FLAGS, cache=True, nogil=True)
+    def cosine_sim(q, targets, out):
+        """
+        余弦相似度：每行一次遍历同时计算点积和范数，结果写入out
+        
+        参数:
+        - q: 查询向量 (dim,)，float32
+        - targets: 目标向量矩阵 (N, dim)，float32
+        - out: 预分配的输出 (N,)，float32
+        """
+        dim = q.shape[0]
+        q_sq = 0.0
+        for j in range(dim):
+            q_sq += q[j] * q[j]
+        q_norm = np.sqrt(q_sq)
+        
+        for i in range(targets.shape[0]):
+            dot = 0.0
+            t_sq = 0.0
+            for j in range(dim):
+                t = targets[i, j]
+                dot += t * q[j]
+                t_sq += t * t
+            out[i] = dot / (np.sqrt(t_sq) * q_norm)